@@ -3,13 +3,28 @@
 import sys, os
 import datetime as dt
 import requests
+import urllib3
+from requests.adapters import HTTPAdapter
+from concurrent.futures import ThreadPoolExecutor
 import io
+import gzip
+import shutil
+import functools
+import json
+import warnings
+import numpy as np
 import pandas as pd
-import xlrd as xl
+import pyarrow as pa
+import pyarrow.csv as pacsv
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
 
 class MisoNodeNotFound(Exception):
     pass
 
+class MisoZoneNotFound(Exception):
+    pass
+
 class MisoTypeNotFound(Exception):
     pass
 
@@ -19,31 +34,54 @@ class MisoValueNotFound(Exception):
 class MisoInvalidDataFormat(Exception):
     pass
 
-def convert_df_al2csv(xls):
-    """Convert Forecast and Actual Load Report from XLS to CSV"""
-    sheet = xls.sheet_by_index(0)
-    result = []
-    for row in range(4):
-        result.append(",".join([str(x.value) for x in sheet.row(row)]))
-    header = ["Zone","Type","Value"]
-    header.extend(list(map(lambda x:str(x),range(24))))
-    result.append(",".join(header))
-    for zone in range(2,len(sheet.row(4)),2):
-        data = [sheet.row(4)[zone].value.split()[0],"Forecast","LOAD"]
-        for row in range(6,30):
-            data.append(str(round(sheet.row(row)[zone].value,2)))
-        result.append(",".join(data))
-    for zone in range(2,len(sheet.row(4)),2):
-        data = [sheet.row(4)[zone].value.split()[0],"Actual","LOAD"]
-        for row in range(6,30):
-            data.append(str(round(sheet.row(row)[zone+1].value,2)))
-        result.append(",".join(data))
-    return "\n".join(result)
+_LMP_DTYPES = {'Node':'category','Type':'category','Value':'category',
+    **{f'HE {hour+1}':'float32' for hour in range(24)}}
+
+_DFAL_DTYPES = {'Zone':'category','Type':'category','Value':'category',
+    **{str(hour):'float64' for hour in range(24)}}
+
+_DTYPES = {'csv':_LMP_DTYPES,'xls':_DFAL_DTYPES}
+
+_ARROW_TYPES = {'category':pa.dictionary(pa.int32(),pa.string()),'float32':pa.float32(),'float64':pa.float64()}
+
+_HOUR_OFFSETS = (np.arange(24,dtype='int64')*3_600_000_000_000).astype('timedelta64[ns]')
+
+def _match(column,value):
+    """Returns a boolean mask of the rows of a column equal to a value
+
+    Categorical columns are compared by category code.
+    """
+    if isinstance(column.dtype,pd.CategoricalDtype):
+        categories = column.cat.categories
+        if value not in categories:
+            return np.zeros(len(column),dtype=bool)
+        return column.cat.codes.to_numpy() == categories.get_loc(value)
+    return (column == value).to_numpy()
+
+def convert_df_al(sheet):
+    """Convert Forecast and Actual Load Report from XLS sheet to dataframe"""
+    zones = sheet.iloc[4,2::2].str.split().str[0].tolist()
+    values = np.round(sheet.iloc[6:30,2:2+2*len(zones)].to_numpy(dtype=np.float64),2)
+    data = pd.DataFrame(np.vstack([values[:,0::2].T,values[:,1::2].T]),
+        columns=[str(hour) for hour in range(24)])
+    data.insert(0,"Zone",zones*2)
+    data.insert(1,"Type",["Forecast"]*len(zones)+["Actual"]*len(zones))
+    data.insert(2,"Value","LOAD")
+    return data
+
+DATASET_CONVERTERS = {
+    'df_al' : convert_df_al,
+    }
 
 class Data:
     """MISO LMP Data Downloader"""
     BASEURL = "https://docs.misoenergy.org/marketreports"
     CACHEDIR = ".cache"
+    MAXAGE = dt.timedelta(days=7)
+    MAXWORKERS = 8
+    MAXCONNECTIONS = 16
+    VALIDATORS = {'ETag':'If-None-Match','Last-Modified':'If-Modified-Since'}
+    COMPRESSED = ['csv']
     DATAFORMATS = {
         'da_exante_lmp' : 'csv',
         'da_expost_lmp' : 'csv',
@@ -52,65 +90,277 @@ class Data:
         'rt_lmp_prelim' : 'csv',
         }
 
-    def __init__(self,dataset,day):
-        """LMP data downloader constructor
+    @classmethod
+    def cachefile(cls,dataset,day):
+        """Returns the cache filename of a dataset day"""
+        fmt = cls.DATAFORMATS[dataset]
+        filename = f"{cls.CACHEDIR}/{dataset}_{day.strftime('%Y%m%d')}.{fmt}"
+        if fmt in cls.COMPRESSED:
+            filename += ".gz"
+        return filename
+
+    @classmethod
+    def parquetfile(cls,dataset,day):
+        """Returns the parsed data cache filename of a dataset day"""
+        return f"{cls.CACHEDIR}/{dataset}_{day.strftime('%Y%m%d')}.parquet"
+
+    @classmethod
+    def is_stale(cls,dataset,day,max_age=None):
+        """Returns True if a dataset day must be downloaded or revalidated
+
+        ARGUMENTS
+
+        dataset - download dataset (see DATAFORMATS)
+        day - day to check (as datetime)
+        max_age - age of day beyond which the cache is not revalidated
+                  (default MAXAGE)
+        """
+        if max_age is None:
+            max_age = cls.MAXAGE
+        return not os.path.exists(cls.cachefile(dataset,day)) or pd.Timestamp.now() - pd.Timestamp(day) <= max_age
+
+    @classmethod
+    def fetch(cls,dataset,day,session=requests):
+        """Download a dataset day into the cache
 
         ARGUMENTS
 
         dataset - download dataset (see DATAFORMATS)
         day - day to download (as datetime)
+        session - requests session to use (default is a new connection)
+
+        If the day is already cached the download is a conditional GET that
+        only transfers the data when it has changed on the server, and the
+        cached data is kept with a warning if the server cannot be reached.
+        Formats listed in COMPRESSED are requested and cached gzip-compressed.
         """
-        if not os.path.exists(self.CACHEDIR):
-            os.makedirs(self.CACHEDIR,exist_ok=True)
-        filename = f"{self.CACHEDIR}/{dataset}_{day.strftime('%Y%m%d')}.{self.DATAFORMATS[dataset]}"
-        if not os.path.exists(filename):
-            url = f"{self.BASEURL}/{day.strftime('%Y%m%d')}_{dataset}.{self.DATAFORMATS[dataset]}"
-            content = requests.get(url).content
-            try:
-                with open(filename,"wb") as fh:
-                    fh.write(content)
-            except:
-                os.remove(filename)
+        if not os.path.exists(cls.CACHEDIR):
+            os.makedirs(cls.CACHEDIR,exist_ok=True)
+        fmt = cls.DATAFORMATS[dataset]
+        filename = cls.cachefile(dataset,day)
+        metaname = f"{filename}.meta"
+        headers = {'Accept-Encoding':'gzip, deflate'}
+        if os.path.exists(filename) and os.path.exists(metaname):
+            with open(metaname,"r") as fh:
+                meta = json.load(fh)
+            for field,header in cls.VALIDATORS.items():
+                if field in meta:
+                    headers[header] = meta[field]
+        url = f"{cls.BASEURL}/{day.strftime('%Y%m%d')}_{dataset}.{fmt}"
+        cached = os.path.exists(filename)
+        partial = f"{filename}.partial"
+        try:
+            with session.get(url,headers=headers,stream=True) as response:
+                if response.status_code == 304:
+                    return
+                response.raise_for_status()
+                compress = filename.endswith(".gz")
+                encoded = compress and response.headers.get('Content-Encoding') == 'gzip'
+                response.raw.decode_content = not encoded
+                with open(partial,"wb") as fh:
+                    if compress and not encoded:
+                        with gzip.GzipFile(fileobj=fh,mode="wb") as gz:
+                            shutil.copyfileobj(response.raw,gz)
+                    else:
+                        shutil.copyfileobj(response.raw,fh)
+                meta = {x:response.headers[x] for x in cls.VALIDATORS if x in response.headers}
+            for name in [metaname,cls.parquetfile(dataset,day)]:
+                if os.path.exists(name):
+                    os.remove(name)
+            os.replace(partial,filename)
+            with open(partial,"w") as fh:
+                json.dump(meta,fh)
+            os.replace(partial,metaname)
+        except (requests.RequestException,urllib3.exceptions.HTTPError) as err:
+            if not cached:
                 raise
-        else:
-            with open(filename,"rb") as fh:
-                content = fh.read()
-        if self.DATAFORMATS[dataset] in ["xls"]:
-            xls = xl.open_workbook(filename)
-            converter = f"convert_{dataset}2csv"
-            if converter not in globals():
-                raise MisoInvalidDataFormat(filename)
-            self.data = globals()[converter](xls)
-
-        elif self.DATAFORMATS[dataset] in ["csv"]:
-            self.data = content.decode('utf-8')
+            warnings.warn(f"unable to revalidate {filename}, using cached data ({err})")
+        finally:
+            if os.path.exists(partial):
+                os.remove(partial)
+
+    @classmethod
+    def fetch_many(cls,dataset,days,max_age=None):
+        """Download the stale days of a dataset concurrently
+
+        ARGUMENTS
+
+        dataset - download dataset (see DATAFORMATS)
+        days - days to download (iterable of datetime)
+        max_age - age of day beyond which the cache is not revalidated
+                  (default MAXAGE)
+
+        All downloads share one session so connections are reused.
+        """
+        days = [day for day in days if cls.is_stale(dataset,day,max_age)]
+        if not days:
+            return
+        with requests.Session() as session:
+            adapter = HTTPAdapter(pool_connections=cls.MAXCONNECTIONS,pool_maxsize=cls.MAXCONNECTIONS)
+            session.mount("https://",adapter)
+            session.mount("http://",adapter)
+            with ThreadPoolExecutor(max_workers=cls.MAXWORKERS) as pool:
+                list(pool.map(lambda day:cls.fetch(dataset,day,session),days))
+
+    def __init__(self,dataset,day,max_age=None,refresh=True):
+        """LMP data downloader constructor
+
+        ARGUMENTS
+
+        dataset - download dataset (see DATAFORMATS)
+        day - day to download (as datetime)
+        max_age - age of day beyond which the cache is not revalidated
+                  (default MAXAGE)
+        refresh - download or revalidate the cache if stale (default True)
+        """
+        fmt = self.DATAFORMATS.get(dataset)
+        if fmt is None:
+            raise MisoInvalidDataFormat(dataset)
+        filename = self.cachefile(dataset,day)
+        if fmt in ["xls"] and dataset not in DATASET_CONVERTERS:
+            raise MisoInvalidDataFormat(filename)
+        if refresh and self.is_stale(dataset,day,max_age):
+            self.fetch(dataset,day)
+        self.dataset = dataset
+        self.format = fmt
+        self.filename = filename
+        self.parquetname = self.parquetfile(dataset,day)
+        self._frame = None
+
+    def _convert(self):
+        """Returns the converted workbook data, converting it on first use"""
+        if self._frame is None:
+            sheet = pd.read_excel(self.filename,sheet_name=0,header=None,engine='xlrd')
+            self._preamble = sheet.iloc[:4].to_csv(header=False,index=False)
+            self._frame = DATASET_CONVERTERS[self.dataset](sheet)
+        return self._frame
 
     def string(self):
         """Returns data as a string in CSV format"""
-        return self.data
+        with self.stream() as fh:
+            return fh.read().decode('utf-8')
 
     def stream(self):
-        """Returns data as a stream in CSV format"""
-        return io.StringIO(self.data)
+        """Returns data as a binary stream in CSV format"""
+        if self.format in ["xls"]:
+            data = self._convert()
+            return io.BytesIO((self._preamble+data.to_csv(index=False)).encode('utf-8'))
+        elif self.filename.endswith(".gz"):
+            return gzip.open(self.filename,"rb")
+        else:
+            return open(self.filename,"rb")
 
-class Node:
-    """MISO Zone Data Class"""
+    def dataframe(self,dtype=None,**columns):
+        """Returns data as a pandas dataframe
+
+        ARGUMENTS
+
+        dtype - column types (default is inferred)
+        columns - value of each column to keep rows of ('*' matches all)
+
+        When dtype is the format's standard column types (see _DTYPES), the
+        parsed data is cached in a parquet file that is used instead of the
+        report as long as it is newer than the report. The rows are selected
+        before they are converted to pandas, so only those are ever copied.
+        """
+        selected = {column:value for column,value in columns.items() if value != '*'}
+        cache = dtype == _DTYPES[self.format]
+        if cache and os.path.exists(self.parquetname) and os.path.getmtime(self.parquetname) >= os.path.getmtime(self.filename):
+            data = pd.read_parquet(self.parquetname,engine='pyarrow',
+                filters=[(column,'==',value) for column,value in selected.items()] or None)
+            if list(data.columns) == list(dtype) and all(str(data[name].dtype) == kind for name,kind in dtype.items()):
+                return data
+        if self.format in ["xls"]:
+            data = self._convert() if dtype is None else self._convert().astype(dtype)
+            table = pa.Table.from_pandas(data,preserve_index=False) if cache else None
+        else:
+            table = pacsv.read_csv(self.filename,
+                read_options=pacsv.ReadOptions(skip_rows=4,use_threads=True),
+                convert_options=None if dtype is None else pacsv.ConvertOptions(include_columns=list(dtype),
+                    column_types={name:_ARROW_TYPES[value] for name,value in dtype.items()}),
+                )
+        if cache:
+            partial = f"{self.parquetname}.partial"
+            try:
+                pq.write_table(table,partial,compression='zstd')
+                os.replace(partial,self.parquetname)
+            finally:
+                if os.path.exists(partial):
+                    os.remove(partial)
+        if self.format in ["xls"]:
+            mask = np.ones(len(data),dtype=bool)
+            for column,value in selected.items():
+                mask &= _match(data[column],value)
+            return data[mask] if selected else data
+        for column,value in selected.items():
+            table = table.filter(pc.equal(table[column],value))
+        return table.to_pandas(self_destruct=True)
+
+@functools.lru_cache(maxsize=256)
+def _parse_day(cachedir,dataset,day,version):
+    """Parse a dataset day, memoized per process
+
+    ARGUMENTS
+
+    cachedir - cache folder the day is read from (Data.CACHEDIR)
+    dataset - dataset to use (see Data.DATAFORMATS)
+    day - day to parse (as datetime)
+    version - modification time of the cache file, so that a refreshed
+              download is parsed again
+
+    Each memoized day holds its whole parsed report in memory (a few MB for
+    an LMP day), so ranges longer than maxsize are not memoized at all
+    rather than evicting every day before it can be reused.
+    """
+    content = Data(dataset,day,refresh=False)
+    return content.dataframe(_DTYPES[Data.DATAFORMATS[dataset]])
+
+def _load_day(dataset,day,memoize=True,**columns):
+    """Returns the parsed data of a cached dataset day
+
+    ARGUMENTS
+
+    dataset - dataset to use (see Data.DATAFORMATS)
+    day - day to load (as datetime)
+    memoize - share the parsed day with later calls (default True)
+    columns - value of each column to keep rows of, the column is dropped
+              unless the value is '*'
+
+    The returned data is never shared so it can be modified.
+    """
+    selected = {column:value for column,value in columns.items() if value != '*'}
+    if not memoize:
+        data = Data(dataset,day,refresh=False).dataframe(_DTYPES[Data.DATAFORMATS[dataset]],**selected)
+        return data.drop(columns=list(selected)) if selected else data
+    data = _parse_day(Data.CACHEDIR,dataset,day,os.path.getmtime(Data.cachefile(dataset,day)))
+    if selected:
+        mask = np.ones(len(data),dtype=bool)
+        for column,value in selected.items():
+            mask &= _match(data[column],value)
+        return data.loc[mask,[x for x in data.columns if x not in selected]]
+    return data.copy()
+
+class _BaseDownload:
+    """MISO Market Report Data Base Class"""
     SHOWPROGRESS = False
     DATEFORMAT = "%Y-%m-%d"
-    VALIDTYPES = {'Interface','Loadzone','Hub','Gennode'}
-    VALIDVALUES = {'LMP','MCC','MLC'}
+    KEY_COLUMN = None
+    KEY_NOTFOUND = None
+    VALIDTYPES = set()
+    VALIDVALUES = set()
 
     def __init__(self,
-        starttime, 
+        starttime,
         stoptime,
         dataset,
         stack = True,
         types = '*',
         values = '*',
-        nodes = '*',
+        keys = '*',
         dropna = True,
+        max_age = None,
         ):
-        """LMP data constructor
+        """Market report data constructor
 
         ARGUMENTS
 
@@ -118,72 +368,126 @@ class Node:
         stoptime - timestamp of last day (required)
         dataset - dataset to use (required)
         stack - stack records with hours in rows (default False)
-        types - zone type to include (default is '*')
+        types - type to include (default is '*')
         values - value type to use (default '*')
-        nodes - node to use (default '*')
+        keys - KEY_COLUMN value to use (default '*')
         dropna - drop NA values (default True)
+        max_age - age of day beyond which the cache is not revalidated
+                  (default Data.MAXAGE)
         """
 
         if types != '*' and types not in self.VALIDTYPES:
             raise MisoTypeNotFound(types)
 
         if values != '*' and values not in self.VALIDVALUES:
-            raise MiseValueNotFound(values)
+            raise MisoValueNotFound(values)
+
+        if dataset not in Data.DATAFORMATS:
+            raise MisoInvalidDataFormat(dataset)
+
+        days = pd.date_range(dt.datetime.strptime(starttime,self.DATEFORMAT),dt.datetime.strptime(stoptime,self.DATEFORMAT),freq='D')
+        Data.fetch_many(dataset,days,max_age)
+        filters = [
+            (self.KEY_COLUMN,keys,self.KEY_NOTFOUND),
+            ("Type",types,MisoTypeNotFound),
+            ("Value",values,MisoValueNotFound),
+            ]
+        columns = {column:value for column,value,exception in filters}
+        memoize = len(days) <= _parse_day.cache_info().maxsize
+        data = pd.concat(self._iter_days(dataset,days,columns,memoize),ignore_index=True)
+        if data.empty:
+            for column,value,exception in filters:
+                if value != '*' and not any(len(_load_day(dataset,day,memoize,**{column:value})) for day in days):
+                    raise exception(value)
+
+        index = ["Datetime"] + [column for column,value,exception in filters if value == '*']
+        for column in index[1:]:
+            if isinstance(data[column].dtype,pd.CategoricalDtype):
+                data[column] = data[column].astype(data[column].cat.categories.dtype)
+
+        if stack:
+            hours = [name for name in _DTYPES[Data.DATAFORMATS[dataset]] if name not in columns]
+            values = data[hours].to_numpy().ravel()
+            arrays = [data["Datetime"].to_numpy(dtype="datetime64[ns]").repeat(24) + np.tile(_HOUR_OFFSETS,len(data))]
+            arrays.extend(data[column].array.repeat(24) for column in index[1:])
+            if dropna:
+                keep = ~pd.isna(values)
+                values = values[keep]
+                arrays = [array[keep] for array in arrays]
+            data = pd.DataFrame({"Value":values},index=pd.MultiIndex.from_arrays(arrays,names=index))
+
+        self.data = data
+
+    def _iter_days(self,dataset,days,columns,memoize):
+        """Generate the filtered data of each day
+
+        ARGUMENTS
 
-        result = []
-        for day in pd.date_range(dt.datetime.strptime(starttime,self.DATEFORMAT),dt.datetime.strptime(stoptime,self.DATEFORMAT),freq='D'):
+        dataset - dataset to use
+        days - days to load (iterable of datetime)
+        columns - value of each column to keep rows of, '*' matches all
+        memoize - share the parsed days with later calls
+
+        When memoized, the full parsed days stay referenced by the memo until
+        evicted, so only long unmemoized ranges release each full day as soon
+        as its rows are selected.
+        """
+        for day in days:
             if self.SHOWPROGRESS:
                 print(f"Processing {dataset} {day}",flush=True,file=sys.stderr,end='... ')
-            content = Data(dataset,day)
-            data = pd.read_csv(content.stream(),skiprows=4)
+            data = _load_day(dataset,day,memoize,**columns)
             data.insert(0,"Datetime",day)
             if self.SHOWPROGRESS:
                 print(f"{len(data)} records found",flush=True,file=sys.stderr)
+            yield data
 
-            index = ["Datetime"]
-            if nodes != '*':
-                data = data[data["Node"] == nodes]
-                data.drop("Node",axis=1,inplace=True)
-            else:
-                index.append("Node")
-
-            if types != '*':
-                data = data[data["Type"] == types]
-                data.drop("Type",axis=1,inplace=True)
-            else:
-                index.append("Type")
+    def dataframe(self):
+        """Return the data as a pandas dataframe"""
+        return self.data
 
-            if values != '*':
-                data = data[data["Value"] == values]
-                data.drop("Value",axis=1,inplace=True)
-            else:
-                index.append("Value")
+class Node(_BaseDownload):
+    """MISO Node Data Class
 
-            if stack:
-                data.set_index(index,inplace=True)
-                data.columns = list(range(24))
-                data = data.stack(dropna=dropna).reset_index()
-                columns = list(data.columns)
-                columns[len(index)] = "hour"
-                data.columns = columns
-                data["Datetime"] = data["Datetime"] + pd.to_timedelta(data["hour"]*3600e9)
-                data.drop("hour",axis=1,inplace=True)
-                data.set_index(index,inplace=True)
-                data.columns = ["Value"]
+    LMP values are returned as float32, which holds the reported two
+    decimal prices to about seven significant digits.
+    """
+    KEY_COLUMN = "Node"
+    KEY_NOTFOUND = MisoNodeNotFound
+    VALIDTYPES = {'Interface','Loadzone','Hub','Gennode'}
+    VALIDVALUES = {'LMP','MCC','MLC'}
 
-            if len(data) > 0:
-                result.append(data)
+    def __init__(self,
+        starttime, 
+        stoptime,
+        dataset,
+        stack = True,
+        types = '*',
+        values = '*',
+        nodes = '*',
+        dropna = True,
+        max_age = None,
+        ):
+        """LMP data constructor
 
-        self.data = pd.concat(result)
+        ARGUMENTS
 
-    def dataframe(self):
-        """Return the LMP data as a pandas dataframe"""
-        return self.data
+        starttime - timestamp of first day (required)
+        stoptime - timestamp of last day (required)
+        dataset - dataset to use (required)
+        stack - stack records with hours in rows (default False)
+        types - zone type to include (default is '*')
+        values - value type to use (default '*')
+        nodes - node to use (default '*')
+        dropna - drop NA values (default True)
+        max_age - age of day beyond which the cache is not revalidated
+                  (default Data.MAXAGE)
+        """
+        super().__init__(starttime,stoptime,dataset,stack,types,values,nodes,dropna,max_age)
 
-class Zone:
+class Zone(_BaseDownload):
     """MISO Zone Data Class"""
-    SHOWPROGRESS = False
-    DATEFORMAT = "%Y-%m-%d"
+    KEY_COLUMN = "Zone"
+    KEY_NOTFOUND = MisoZoneNotFound
     VALIDTYPES = {'Forecast','Actual'}
     VALIDVALUES = {'LOAD'}
 
@@ -196,6 +500,7 @@ class Zone:
         values = '*',
         zones = '*',
         dropna = True,
+        max_age = None,
         ):
         """DFAL data constructor
 
@@ -209,66 +514,16 @@ class Zone:
         values - value type to use (default '*')
         zones - zone to use (default '*')
         dropna - drop NA values (default True)
+        max_age - age of day beyond which the cache is not revalidated
+                  (default Data.MAXAGE)
         """
-
-        if types != '*' and types not in self.VALIDTYPES:
-            raise MisoTypeNotFound(types)
-
-        if values != '*' and values not in self.VALIDVALUES:
-            raise MiseValueNotFound(values)
-
-        result = []
-        for day in pd.date_range(dt.datetime.strptime(starttime,self.DATEFORMAT),dt.datetime.strptime(stoptime,self.DATEFORMAT),freq='D'):
-            if self.SHOWPROGRESS:
-                print(f"Processing {dataset} {day}",flush=True,file=sys.stderr,end='... ')
-            content = Data(dataset,day)
-            data = pd.read_csv(content.stream(),skiprows=4)
-            data.insert(0,"Datetime",day)
-            if self.SHOWPROGRESS:
-                print(f"{len(data)} records found",flush=True,file=sys.stderr)
-
-            index = ["Datetime"]
-            if zones != '*':
-                data = data[data["Zone"] == zones]
-                data.drop("Zone",axis=1,inplace=True)
-            else:
-                index.append("Zone")
-
-            if types != '*':
-                data = data[data["Type"] == types]
-                data.drop("Type",axis=1,inplace=True)
-            else:
-                index.append("Type")
-
-            if values != '*':
-                data = data[data["Value"] == values]
-                data.drop("Value",axis=1,inplace=True)
-            else:
-                index.append("Value")
-
-            if stack:
-                data.set_index(index,inplace=True)
-                data.columns = list(range(24))
-                data = data.stack(dropna=dropna).reset_index()
-                columns = list(data.columns)
-                columns[len(index)] = "hour"
-                data.columns = columns
-                data["Datetime"] = data["Datetime"] + pd.to_timedelta(data["hour"]*3600e9)
-                data.drop("hour",axis=1,inplace=True)
-                data.set_index(index,inplace=True)
-                data.columns = ["Value"]
-
-            if len(data) > 0:
-                result.append(data)
-
-        self.data = pd.concat(result)
-
-    def dataframe(self):
-        """Return the DFAL data as a pandas dataframe"""
-        return self.data
+        super().__init__(starttime,stoptime,dataset,stack,types,values,zones,dropna,max_age)
 
 if __name__ == "__main__":
     import unittest
+    import tempfile
+    import threading
+    import http.server
 
     class TestLMP(unittest.TestCase):
     
@@ -320,8 +575,213 @@ if __name__ == "__main__":
             lmp = Node("2021-01-01","2021-01-07","rt_lmp_final",values='LMP')
             self.assertEqual(len(lmp.dataframe()),382872)
 
+        def test_node_not_found(self):
+            with self.assertRaises(MisoNodeNotFound):
+                Node("2021-01-01","2021-01-01","rt_lmp_final",nodes='NOSUCHNODE')
+
         def test_xls(self):
             dfal = Zone("2022-01-31","2022-01-31","df_al")
             self.assertEqual(len(dfal.dataframe()),336)
 
+    class ReportHandler(http.server.BaseHTTPRequestHandler):
+        """Serves REPORTS by path with ETag validation, other paths fail"""
+        REPORTS = {}
+        REQUESTS = []
+        ENCODING = None
+        TRUNCATED = False
+
+        def do_GET(self):
+            self.REQUESTS.append((self.path,self.headers.get('If-None-Match')))
+            if self.path not in self.REPORTS:
+                self.send_error(500)
+                return
+            etag,body = self.REPORTS[self.path]
+            if self.headers.get('If-None-Match') == etag:
+                self.send_response(304)
+                self.end_headers()
+                return
+            self.send_response(200)
+            self.send_header('ETag',etag)
+            if self.ENCODING == 'gzip':
+                body = gzip.compress(body)
+                self.send_header('Content-Encoding','gzip')
+            self.send_header('Content-Length',str(len(body)))
+            self.end_headers()
+            if self.TRUNCATED:
+                self.wfile.write(body[:len(body)//2])
+                self.close_connection = True
+            else:
+                self.wfile.write(body)
+
+        def log_message(self,*args):
+            pass
+
+    def report(value,rows=[("TEST.NODE","Loadzone","LMP")]):
+        """Returns an LMP report of rows (node,type,value,hours...) with missing hours set to value"""
+        lines = ["Real-Time Market LMPs","01/01/2021",",","EST",
+            ",".join(["Node","Type","Value"]+[f"HE {hour+1}" for hour in range(24)])]
+        lines.extend(",".join(list(row)+[str(value)]*(27-len(row))) for row in rows)
+        return ("\n".join(lines)+"\n").encode('utf-8')
+
+    class TestData(unittest.TestCase):
+        DAY = dt.datetime(2021,1,1)
+        PATH = "/20210101_rt_lmp_final.csv"
+
+        @classmethod
+        def setUpClass(cls):
+            cls.server = http.server.ThreadingHTTPServer(("127.0.0.1",0),ReportHandler)
+            threading.Thread(target=cls.server.serve_forever,daemon=True).start()
+            cls.baseurl,cls.cachedir = Data.BASEURL,Data.CACHEDIR
+            Data.BASEURL = f"http://127.0.0.1:{cls.server.server_port}"
+
+        @classmethod
+        def tearDownClass(cls):
+            cls.server.shutdown()
+            cls.server.server_close()
+            Data.BASEURL,Data.CACHEDIR = cls.baseurl,cls.cachedir
+
+        def setUp(self):
+            self.tmpdir = tempfile.TemporaryDirectory()
+            Data.CACHEDIR = self.tmpdir.name
+            ReportHandler.REPORTS.clear()
+            ReportHandler.REQUESTS.clear()
+            ReportHandler.ENCODING = None
+            ReportHandler.TRUNCATED = False
+
+        def tearDown(self):
+            self.tmpdir.cleanup()
+
+        def test_not_modified(self):
+            ReportHandler.REPORTS[self.PATH] = ('"v1"',report(1.5))
+            Data.fetch("rt_lmp_final",self.DAY)
+            Data.fetch("rt_lmp_final",self.DAY)
+            self.assertEqual(ReportHandler.REQUESTS,[(self.PATH,None),(self.PATH,'"v1"')])
+            self.assertEqual(Data("rt_lmp_final",self.DAY,refresh=False).string(),report(1.5).decode('utf-8'))
+
+        def test_gzip_encoding(self):
+            ReportHandler.REPORTS[self.PATH] = ('"v1"',report(1.5))
+            ReportHandler.ENCODING = 'gzip'
+            Data.fetch("rt_lmp_final",self.DAY)
+            with gzip.open(Data.cachefile("rt_lmp_final",self.DAY),"rb") as fh:
+                self.assertEqual(fh.read(),report(1.5))
+            data = Data("rt_lmp_final",self.DAY,refresh=False).dataframe(_LMP_DTYPES)
+            self.assertEqual(data["HE 24"].iloc[0],1.5)
+
+        def test_http_error(self):
+            with self.assertRaises(requests.HTTPError):
+                Data.fetch("rt_lmp_final",self.DAY)
+            self.assertEqual(os.listdir(Data.CACHEDIR),[])
+
+        def test_offline(self):
+            ReportHandler.REPORTS[self.PATH] = ('"v1"',report(1.5))
+            Data.fetch("rt_lmp_final",self.DAY)
+            ReportHandler.REPORTS.clear()
+            with self.assertWarns(UserWarning):
+                Data.fetch("rt_lmp_final",self.DAY)
+            self.assertEqual(Data("rt_lmp_final",self.DAY,refresh=False).string(),report(1.5).decode('utf-8'))
+            self.assertEqual(sorted(os.listdir(Data.CACHEDIR)),["rt_lmp_final_20210101.csv.gz","rt_lmp_final_20210101.csv.gz.meta"])
+
+        def test_truncated(self):
+            ReportHandler.REPORTS[self.PATH] = ('"v1"',report(1.5))
+            Data.fetch("rt_lmp_final",self.DAY)
+            ReportHandler.REPORTS[self.PATH] = ('"v2"',report(2.5))
+            ReportHandler.TRUNCATED = True
+            with self.assertWarns(UserWarning):
+                Data.fetch("rt_lmp_final",self.DAY)
+            self.assertEqual(Data("rt_lmp_final",self.DAY,refresh=False).string(),report(1.5).decode('utf-8'))
+            self.assertEqual(sorted(os.listdir(Data.CACHEDIR)),["rt_lmp_final_20210101.csv.gz","rt_lmp_final_20210101.csv.gz.meta"])
+
+        def test_max_age(self):
+            ReportHandler.REPORTS[self.PATH] = ('"v1"',report(1.5))
+            Node("2021-01-01","2021-01-01","rt_lmp_final",max_age=dt.timedelta(days=100000))
+            Node("2021-01-01","2021-01-01","rt_lmp_final",max_age=dt.timedelta(days=100000))
+            Node("2021-01-01","2021-01-01","rt_lmp_final")
+            self.assertEqual(ReportHandler.REQUESTS,[(self.PATH,None),(self.PATH,'"v1"')])
+
+        def test_memoized_cachedir(self):
+            ReportHandler.REPORTS[self.PATH] = ('"v1"',report(1.5))
+            first = Node("2021-01-01","2021-01-01","rt_lmp_final").dataframe()
+            mtime = os.path.getmtime(Data.cachefile("rt_lmp_final",self.DAY))
+            with tempfile.TemporaryDirectory() as cachedir:
+                Data.CACHEDIR = cachedir
+                ReportHandler.REPORTS[self.PATH] = ('"v2"',report(2.5))
+                Data.fetch("rt_lmp_final",self.DAY)
+                os.utime(Data.cachefile("rt_lmp_final",self.DAY),(mtime,mtime))
+                second = Node("2021-01-01","2021-01-01","rt_lmp_final").dataframe()
+            self.assertEqual(first["Value"].iloc[0],1.5)
+            self.assertEqual(second["Value"].iloc[0],2.5)
+
+        def test_not_found(self):
+            ReportHandler.REPORTS[self.PATH] = ('"v1"',report(1.5,[("N1","Loadzone","LMP"),("N2","Hub","LMP")]))
+            self.assertEqual(len(Node("2021-01-01","2021-01-01","rt_lmp_final",types="Hub").dataframe()),24)
+            self.assertEqual(len(Node("2021-01-01","2021-01-01","rt_lmp_final",nodes="N1",types="Hub").dataframe()),0)
+            with self.assertRaises(MisoNodeNotFound):
+                Node("2021-01-01","2021-01-01","rt_lmp_final",nodes="N3",types="Hub")
+            with self.assertRaises(MisoTypeNotFound):
+                Node("2021-01-01","2021-01-01","rt_lmp_final",nodes="N1",types="Gennode")
+
+        def test_pushdown(self):
+            ReportHandler.REPORTS[self.PATH] = ('"v1"',report(1.5,[("N1","Loadzone","LMP"),("N2","Hub","LMP")]))
+            Data.fetch("rt_lmp_final",self.DAY)
+            for parsed in ["report","parquet"]:
+                data = Data("rt_lmp_final",self.DAY,refresh=False).dataframe(_LMP_DTYPES,Node="N2",Type='*')
+                self.assertEqual(data["Node"].tolist(),["N2"],parsed)
+                self.assertTrue(os.path.exists(Data.parquetfile("rt_lmp_final",self.DAY)),parsed)
+            self.assertEqual(len(pd.read_parquet(Data.parquetfile("rt_lmp_final",self.DAY))),2)
+            data = _load_day("rt_lmp_final",self.DAY,False,Node="N1",Type="Hub")
+            self.assertEqual((len(data),list(data.columns[:2])),(0,["Value","HE 1"]))
+
+        def test_labels(self):
+            ReportHandler.REPORTS[self.PATH] = ('"v1"',report(1.5,[("N1","Loadzone","LMP"),("N2","Hub","LMP")]))
+            for stack in [True,False]:
+                data = Node("2021-01-01","2021-01-01","rt_lmp_final",stack=stack,types="Hub").dataframe()
+                nodes = data.index.get_level_values("Node") if stack else data["Node"]
+                self.assertNotEqual(nodes.dtype,"category")
+                self.assertEqual(data.groupby("Node").size().index.tolist(),["N2"])
+
+        def test_stacked(self):
+            rows = [("N1","Loadzone","LMP",*[str(hour+1) for hour in range(24)]),("N2","Hub","LMP",*[str(hour+101) for hour in range(24)])]
+            ReportHandler.REPORTS[self.PATH] = ('"v1"',report(0,[rows[0][:7]+("",)+rows[0][8:],rows[1]]))
+            ReportHandler.REPORTS["/20210102_rt_lmp_final.csv"] = ('"v1"',report(0,rows))
+            data = Node("2021-01-01","2021-01-02","rt_lmp_final").dataframe()
+            expected = [((dt.datetime(2021,1,1+day,hour),node,kind,"LMP"),float(hour+1+offset))
+                for day in range(2) for node,kind,offset in [("N1","Loadzone",0),("N2","Hub",100)] for hour in range(24)
+                if (day,node,hour) != (0,"N1",4)]
+            self.assertEqual(list(data.index.names),["Datetime","Node","Type","Value"])
+            self.assertEqual(list(zip(data.index,data["Value"])),expected)
+
+        def test_parquet_dtype(self):
+            ReportHandler.REPORTS[self.PATH] = ('"v1"',report(1.5))
+            Data.fetch("rt_lmp_final",self.DAY)
+            self.assertNotEqual(Data("rt_lmp_final",self.DAY,refresh=False).dataframe()["Node"].dtype,"category")
+            data = Data("rt_lmp_final",self.DAY,refresh=False).dataframe(_LMP_DTYPES)
+            self.assertEqual(data["Node"].dtype,"category")
+            self.assertEqual(data["HE 1"].dtype,"float32")
+
+        def test_parquet_invalidated(self):
+            ReportHandler.REPORTS[self.PATH] = ('"v1"',report(1.5))
+            Data.fetch("rt_lmp_final",self.DAY)
+            data = Data("rt_lmp_final",self.DAY,refresh=False).dataframe(_LMP_DTYPES)
+            self.assertEqual(data["HE 1"].iloc[0],1.5)
+            ReportHandler.REPORTS[self.PATH] = ('"v2"',report(2.5))
+            Data.fetch("rt_lmp_final",self.DAY)
+            data = Data("rt_lmp_final",self.DAY,refresh=False).dataframe(_LMP_DTYPES)
+            self.assertEqual(data["HE 1"].iloc[0],2.5)
+
+    class TestConvert(unittest.TestCase):
+
+        def test_df_al(self):
+            sheet = pd.DataFrame(np.nan,index=range(30),columns=range(6),dtype=object)
+            sheet.iloc[4,2:] = ["LRZ1 MTLF (MWh)",np.nan,"LRZ2 MTLF (MWh)",np.nan]
+            for hour in range(24):
+                sheet.iloc[6+hour,2:] = [hour+0.123,hour+0.456,100+hour+0.123,100+hour+0.456]
+            data = convert_df_al(sheet)
+            self.assertEqual(data["Zone"].tolist(),["LRZ1","LRZ2","LRZ1","LRZ2"])
+            self.assertEqual(data["Type"].tolist(),["Forecast","Forecast","Actual","Actual"])
+            self.assertEqual(data["Value"].tolist(),["LOAD"]*4)
+            self.assertEqual(list(data.columns[3:]),[str(hour) for hour in range(24)])
+            self.assertEqual(data["0"].tolist(),[0.12,100.12,0.46,100.46])
+            self.assertEqual(data["23"].tolist(),[23.12,123.12,23.46,123.46])
+            self.assertTrue(all(data[str(hour)].dtype == "float64" for hour in range(24)))
+
     unittest.main()